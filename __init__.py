@@ -4,4 +4,5 @@ __version__ = '0.1.2'
 
 from .alfred import Workflow, WorkflowInfo, Item, Menu, Command, Keyword
 from .jsonfile import JsonFile
+from .corpus import Corpus, write_corpus, load_corpus
 from .keychain import Keychain
@@ -5,8 +5,13 @@ import logging
 import plistlib
 import os.path
 import json
+import time
 import uuid
+from itertools import islice
+from timeit import default_timer
 from .jsonfile import JsonFile
+from .corpus import Corpus, CorpusRecord
+from .textfold import fold
 from xml.etree.ElementTree import Element, SubElement, tostring
 
 
@@ -45,10 +50,19 @@ class Item(object):
         self.arg = arg
         self.prefix = prefix
         self.autocomplete = autocomplete
+        self._search_key = None
 
         if not uid and random_uid:
             self.uid = str(uuid.uuid4())
 
+    @property
+    def search_key(self):
+        '''The folded form of this item's title, for matching'''
+        if self._search_key is None or self._search_key_title != self.title:
+            self._search_key = fold(self.title)
+            self._search_key_title = self.title
+        return self._search_key
+
     @classmethod
     def from_dict(cls, obj):
         return Item(title=obj['title'],
@@ -117,6 +131,22 @@ class Item(object):
         return self.__str__()
 
 
+class _SummaryItem(Item):
+    '''An item standing in for results that were left out of the output'''
+
+    def __init__(self, shown, total=None):
+        self.shown = shown
+        self.total = total
+        if total is None:
+            super(_SummaryItem, self).__init__(
+                'More results not shown',
+                subtitle='Showing the first %d results' % shown)
+        else:
+            super(_SummaryItem, self).__init__(
+                '%d more results not shown' % (total - shown),
+                subtitle='Showing %d of %d results' % (shown, total))
+
+
 class WorkflowInfo(object):
     def __init__(self, path=None):
         if not path:
@@ -211,6 +241,9 @@ class Menu(Command):
 
 
 class Workflow(object):
+    # set to True to have the match methods transliterate letters like "ø"
+    # that don't decompose to ASCII
+    transliterate = False
 
     def __init__(self):
         self._info = WorkflowInfo()
@@ -240,6 +273,38 @@ class Workflow(object):
         self.config['loglevel'] = level
         logging.getLogger().setLevel(getattr(logging, level))
 
+    @property
+    def record_sessions(self):
+        return self.config.get('record_sessions', False)
+
+    @record_sessions.setter
+    def record_sessions(self, record):
+        self.config['record_sessions'] = record
+
+    @property
+    def session_file(self):
+        return os.path.join(self.cache_dir, 'sessions.log')
+
+    @property
+    def memory_report(self):
+        return self.config.get('memory_report', False)
+
+    @memory_report.setter
+    def memory_report(self, report):
+        self.config['memory_report'] = report
+
+    @property
+    def memory_report_file(self):
+        return os.path.join(self.cache_dir, 'memory.txt')
+
+    @property
+    def max_results(self):
+        return self.config.get('max_results')
+
+    @property
+    def max_bytes(self):
+        return self.config.get('max_bytes')
+
     @property
     def info(self):
         return self._info
@@ -302,10 +367,13 @@ class Workflow(object):
         return items
 
     def fuzzy_match(self, test, text, words=False, ordered=True):
-        '''Return true if the given text fuzzy matches the test'''
+        '''Return true if the given text fuzzy matches the test
+
+        Matching ignores case and diacritics, so "cafe" matches "Café".
+        '''
         start = 0
-        test = test.lower()
-        text = text.lower()
+        test = fold(test, self.transliterate)
+        text = fold(text, self.transliterate)
 
         if words:
             tokens = test.split()
@@ -326,27 +394,57 @@ class Workflow(object):
 
     def partial_match(self, test, text, words=False, ordered=True):
         '''Return true if the given text partially matches the test'''
-        return text.lower().startswith(test.lower())
+        return fold(text, self.transliterate).startswith(
+            fold(test, self.transliterate))
 
     def match_list(self, test, items, matcher=None, key=None, words=False,
                    ordered=True):
-        '''Return the subset of items that match a string [test]'''
-        matches = []
-        for item in items:
-            if key:
-                istr = key(item)
-            else:
-                istr = str(item)
+        '''Return the subset of items that match a string [test]
 
+        [items] may also be a Corpus, in which case only the matching entries
+        are read in full and returned as Items.
+        '''
+        # the built-in matchers compare folded keys, so fold the test once here
+        # rather than once per item
+        folding = matcher in (self.fuzzy_match, self.partial_match)
+        if folding:
+            test = fold(test, self.transliterate)
+
+        matches = []
+        for item, istr in self._match_strings(items, key, folding):
             is_match = False
             if matcher:
                 is_match = matcher(test, istr, words=words, ordered=ordered)
             else:
                 is_match = test == istr
             if is_match:
+                if isinstance(item, CorpusRecord):
+                    item = item.to_item()
                 matches.append(item)
         return matches
 
+    def _match_strings(self, items, key, folding):
+        '''Yield (item, string) pairs for match_list to test'''
+        if (folding and key is None and isinstance(items, Corpus) and
+                items.transliterate == self.transliterate):
+            # the corpus has precomputed search keys for its titles
+            records = iter(items)
+            for search_key in items.search_keys():
+                yield next(records), search_key
+            return
+
+        for item in items:
+            if key:
+                yield item, key(item)
+            elif isinstance(item, CorpusRecord):
+                title = item.title
+                if folding and title is None:
+                    # like the precomputed search key of a missing title
+                    title = u''
+                yield item, title
+            else:
+                yield item, str(item)
+
     def fuzzy_match_list(self, test, items, key=None, words=False,
                          ordered=True):
         '''Return the subset of items that fuzzy match a string [test]'''
@@ -359,15 +457,63 @@ class Workflow(object):
         return self.match_list(test, items, self.partial_match, key, words,
                                ordered)
 
-    def to_xml(self, items):
-        '''Convert a list of Items to an Alfred XML feedback message'''
-        msg = [u'<?xml version="1.0"?>', u'<items>']
+    def to_xml(self, items, max_bytes=None):
+        '''Convert a list of Items to an Alfred XML feedback message
 
-        for item in items:
-            msg.append(item.to_xml())
+        If [max_bytes] is given, the whole message is kept within that many
+        bytes where possible; items that don't fit are dropped and replaced by
+        a summary item. A summary item that tell added after limiting the
+        number of results is updated rather than duplicated.
+        '''
+        head = u'<?xml version="1.0"?><items>'
+        tail = u'</items>'
+        size = len(head) + len(tail)
+        msg = []
+        total = None
+        if isinstance(items, list):
+            if items and isinstance(items[-1], _SummaryItem):
+                total = items[-1].total
+            else:
+                total = len(items)
+        summarize = False
 
-        msg.append(u'</items>')
-        return u''.join(msg)
+        for item in items:
+            if isinstance(item, _SummaryItem):
+                summarize = True
+                break
+            xml = item.to_xml()
+            if max_bytes is not None and size + len(xml) > max_bytes:
+                summarize = True
+                break
+            msg.append(xml)
+            size += len(xml)
+
+        if summarize:
+            # drop items until the summary fits too
+            while True:
+                xml = _SummaryItem(len(msg), total).to_xml()
+                if (max_bytes is None or size + len(xml) <= max_bytes or
+                        not msg):
+                    break
+                size -= len(msg.pop())
+            msg.append(xml)
+
+        return head + u''.join(msg) + tail
+
+    def _limit_results(self, items, max_results):
+        '''Return at most [max_results] items, plus a summary item if some
+        were left out. Items are only consumed as far as needed, so a handler
+        can return a generator over an unbounded set of results.'''
+        if isinstance(items, list):
+            if len(items) <= max_results:
+                return items
+            return items[:max_results] + [
+                _SummaryItem(max_results, len(items))]
+
+        limited = list(islice(items, max_results + 1))
+        if len(limited) > max_results:
+            limited = limited[:max_results] + [_SummaryItem(max_results)]
+        return limited
 
     def run_script(self, script):
         '''Run an AppleScript, returning its output'''
@@ -482,36 +628,137 @@ class Workflow(object):
 
         return self.run_script(script)
 
-    def tell(self, name, query=''):
-        '''Tell something.'''
+    def tell(self, name, query='', max_results=None, max_bytes=None):
+        '''Tell something.
+
+        The output can be limited to [max_results] items and [max_bytes] bytes
+        of XML; results beyond either limit are replaced by a summary item.
+        The limits default to the max_results and max_bytes config values.
+        '''
         LOG.debug('tell(%s, %s)', name, query)
+        report = self._start_memory_report()
+        start = default_timer()
+
+        if max_results is None:
+            max_results = self.max_results
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
         try:
-            cmd = 'tell_%s' % name
-            if getattr(self, cmd):
-                items = getattr(self, cmd)(query)
-            else:
-                items = [Item('Invalid action "%s"' % name)]
-        except Exception as e:
-            LOG.exception('Error telling')
-            items = [Item('Error: %s' % e)]
-        self.puts(self.to_xml(items))
+            try:
+                cmd = 'tell_%s' % name
+                if getattr(self, cmd):
+                    items = getattr(self, cmd)(query)
+                    if max_results is not None:
+                        items = self._limit_results(items, max_results)
+                else:
+                    items = [Item('Invalid action "%s"' % name)]
+            except Exception as e:
+                LOG.exception('Error telling')
+                items = [Item('Error: %s' % e)]
+            self.puts(self.to_xml(items, max_bytes))
+            duration = default_timer() - start
+        finally:
+            if report:
+                self._write_memory_report(report, 'tell', name, query)
+        self._record_call('tell', name, query, None, duration)
 
     def do(self, name, query='', modifier=None):
         '''Do something.'''
+        report = self._start_memory_report()
+        start = default_timer()
         try:
-            cmd = 'do_%s' % name
-            doer = getattr(self, cmd)
-            if doer:
-                if modifier:
-                    doer(query, modifier)
+            try:
+                cmd = 'do_%s' % name
+                doer = getattr(self, cmd)
+                if doer:
+                    if modifier:
+                        doer(query, modifier)
+                    else:
+                        doer(query)
                 else:
-                    doer(query)
-            else:
-                self.puts('Invalid command "%s"' % name)
-        except Exception as e:
-            LOG.exception('Error showing')
-            self.puts('Error: %s' % e)
+                    self.puts('Invalid command "%s"' % name)
+            except Exception as e:
+                LOG.exception('Error showing')
+                self.puts('Error: %s' % e)
+            duration = default_timer() - start
+        finally:
+            if report:
+                self._write_memory_report(report, 'do', name, query)
+        self._record_call('do', name, query, modifier, duration)
+
+    def _record_call(self, kind, name, query, modifier, duration):
+        '''Append a tell or do call that took [duration] seconds to the
+        session log if recording is enabled'''
+        if not self.record_sessions:
+            return
+        record = {
+            'kind': kind,
+            'name': name,
+            'query': query,
+            'modifier': modifier,
+            'timestamp': time.time() - duration,
+            'duration': duration
+        }
+        try:
+            with open(self.session_file, 'at') as sfile:
+                sfile.write(json.dumps(record) + '\n')
+        except IOError:
+            LOG.exception('Error recording session')
+
+    def _start_memory_report(self):
+        '''Start a memory report if memory reports are enabled.
 
+        Returns the kind of report that was started: 'tracemalloc' (Python
+        3.4+), which traces allocations, 'rusage', which only records the peak
+        size of the process, or None.
+        '''
+        if not self.memory_report:
+            return None
+        try:
+            import tracemalloc
+        except ImportError:
+            return 'rusage'
+        tracemalloc.start()
+        return 'tracemalloc'
+
+    def _write_memory_report(self, report, kind, name, query, limit=10):
+        '''Write peak memory use, and the top allocation sites if they were
+        traced, to memory_report_file'''
+        lines = ['%s_%s("%s") at %s' % (kind, name, query, time.ctime())]
+
+        if report == 'tracemalloc':
+            import tracemalloc
+            try:
+                current, peak = tracemalloc.get_traced_memory()
+                stats = tracemalloc.take_snapshot().statistics('lineno')
+            finally:
+                tracemalloc.stop()
+
+            lines.append('peak: %.1f KiB, current: %.1f KiB' % (
+                peak / 1024.0, current / 1024.0))
+            lines.append('top allocations:')
+            for stat in stats[:limit]:
+                frame = stat.traceback[0]
+                lines.append('  %s:%d: %.1f KiB in %d blocks' % (
+                    frame.filename, frame.lineno, stat.size / 1024.0,
+                    stat.count))
+        else:
+            import resource
+            import sys
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is in bytes on OS X, and KiB elsewhere
+            if sys.platform == 'darwin':
+                peak /= 1024.0
+            lines.append('peak process size: %.1f KiB' % peak)
+            lines.append('(allocation sites are only traced on Python 3.4+, '
+                         'which has tracemalloc)')
+
+        try:
+            with open(self.memory_report_file, 'wt') as mfile:
+                mfile.write('\n'.join(lines) + '\n')
+        except IOError:
+            LOG.exception('Error writing memory report')
 
 if __name__ == '__main__':
     from sys import argv
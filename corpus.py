@@ -0,0 +1,333 @@
+'''A compact, memory-mapped store for large lists of Alfred items.
+
+A corpus file holds the title, subtitle, arg, uid and icon of each item in
+offset-indexed columns. Opening a corpus only maps the file; strings are
+decoded when they're read, so a `tell_*` handler that searches titles never
+touches the pages holding the other columns of non-matching items.
+'''
+
+import json
+import logging
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+from .textfold import fold, SearchKey, TransliteratedSearchKey
+
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'JCAC'
+VERSION = 3
+COLUMNS = ('title', 'subtitle', 'arg', 'uid', 'icon')
+# the stored columns also include the folded title, for matching
+_STORED = COLUMNS + ('key',)
+
+# magic, version, column count, item count, source mtime, source size,
+# whether search keys are transliterated
+_HEADER = struct.Struct('<4sHHIdQ?')
+_OFFSET = struct.Struct('<I')
+_SPAN = struct.Struct('<II')
+_FLAGS = struct.Struct('<B')
+
+_VALID = 0x01
+_ICON_DICT = 0x02
+# a set bit means the value for that column is None
+_NULL_BITS = dict((name, 0x04 << i) for i, name in enumerate(COLUMNS))
+
+
+def _source_stamp(source):
+    '''Return the (mtime, size) of a source file, or (0, 0) if there isn't
+    one'''
+    if source is None or not os.path.exists(source):
+        return 0.0, 0
+    st = os.stat(source)
+    return st.st_mtime, st.st_size
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _item_values(item):
+    '''Return a dict of corpus values for an Item or an item dict'''
+    if isinstance(item, dict):
+        return item
+    return item.to_dict()
+
+
+def write_corpus(path, items, source=None, transliterate=False):
+    '''Write a list of Items (or dicts in Item.to_dict() form) to a corpus
+    file.
+
+    If a source path is given, its modification time and size are recorded so
+    that load_corpus can tell when the corpus is out of date. The titles'
+    search keys are folded with transliteration if transliterate is True; it
+    should match the transliterate setting of the workflows that will search
+    the corpus. The file is written to a temporary file in the same directory
+    and renamed into place, so readers never see a partial corpus.
+    '''
+    flags = bytearray()
+    columns = dict((name, []) for name in _STORED)
+
+    for item in items:
+        values = _item_values(item)
+        flag = _VALID if values.get('valid') else 0
+
+        for name in COLUMNS:
+            value = values.get(name)
+            if value is None:
+                flag |= _NULL_BITS[name]
+                value = ''
+            elif name == 'icon' and isinstance(value, dict):
+                flag |= _ICON_DICT
+                value = json.dumps(value)
+            columns[name].append(_encode(value))
+
+        title = values.get('title')
+        key = fold(title, transliterate) if title is not None else u''
+        columns['key'].append(_encode(key))
+        flags.append(flag)
+
+    count = len(flags)
+    mtime, size = _source_stamp(source)
+    header = _HEADER.pack(MAGIC, VERSION, len(_STORED), count, mtime, size,
+                          transliterate)
+
+    # data for all columns follows the flags and the offset tables; each
+    # table has count + 1 absolute offsets so that entry i spans
+    # [offsets[i], offsets[i + 1])
+    position = len(header) + count + (count + 1) * _OFFSET.size * len(_STORED)
+    tables = []
+    for name in _STORED:
+        offsets = [position]
+        for value in columns[name]:
+            position += len(value)
+            offsets.append(position)
+        tables.append(b''.join(_OFFSET.pack(o) for o in offsets))
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as cfile:
+            cfile.write(header)
+            cfile.write(bytes(flags))
+            for table in tables:
+                cfile.write(table)
+            for name in _STORED:
+                cfile.write(b''.join(columns[name]))
+        # mkstemp creates files that only the owner can read
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    LOG.debug('wrote %d items to corpus %s', count, path)
+
+
+def load_corpus(path, source, loader, transliterate=False):
+    '''Open the corpus at path, rebuilding it first if source has changed.
+
+    The corpus is only rebuilt when the modification time or size of the
+    source file differs from the one recorded when the corpus was written, so
+    the (potentially slow) loader is only called when the source data actually
+    changes. loader is called with the source path and should return a list of
+    Items or item dicts. The corpus is also rebuilt if it was written with a
+    different transliterate setting (see write_corpus). A rebuild always
+    rewrites the whole corpus; there's no support for updating only the items
+    that changed.
+    '''
+    if is_stale(path, source, transliterate):
+        LOG.debug('rebuilding corpus %s from %s', path, source)
+        write_corpus(path, loader(source), source=source,
+                     transliterate=transliterate)
+    return Corpus(path)
+
+
+def is_stale(path, source, transliterate=False):
+    '''Return True if the corpus at path doesn't reflect the current state of
+    source, or wasn't written with the given transliterate setting'''
+    if not os.path.exists(path):
+        return True
+    try:
+        with open(path, 'rb') as cfile:
+            header = _HEADER.unpack(cfile.read(_HEADER.size))
+    except struct.error:
+        return True
+    magic, version, ncols, count, mtime, size, transliterated = header
+    if magic != MAGIC or version != VERSION:
+        return True
+    if transliterated != bool(transliterate):
+        return True
+    return (mtime, size) != _source_stamp(source)
+
+
+class CorpusRecord(object):
+    '''A lazy view of one item in a Corpus.
+
+    Column values are read from the corpus when they're accessed. Use
+    to_item() to get a real Item.
+    '''
+
+    __slots__ = ('_corpus', '_index')
+
+    def __init__(self, corpus, index):
+        self._corpus = corpus
+        self._index = index
+
+    @property
+    def title(self):
+        return self._corpus._value('title', self._index)
+
+    @property
+    def subtitle(self):
+        return self._corpus._value('subtitle', self._index)
+
+    @property
+    def arg(self):
+        return self._corpus._value('arg', self._index)
+
+    @property
+    def uid(self):
+        return self._corpus._value('uid', self._index)
+
+    @property
+    def icon(self):
+        return self._corpus._value('icon', self._index)
+
+    @property
+    def search_key(self):
+        '''The folded form of this item's title, for matching'''
+        return self._corpus._key_type(
+            self._corpus._value('key', self._index))
+
+    @property
+    def valid(self):
+        return bool(self._corpus._flags(self._index) & _VALID)
+
+    def to_dict(self):
+        flags = self._corpus._flags(self._index)
+        values = dict((name, self._corpus._value(name, self._index, flags))
+                      for name in COLUMNS)
+        values['valid'] = bool(flags & _VALID)
+        return values
+
+    def to_item(self):
+        from .alfred import Item
+        return Item.from_dict(self.to_dict())
+
+    def to_xml(self):
+        return self.to_item().to_xml()
+
+    def __str__(self):
+        return self.title
+
+    def __repr__(self):
+        return '{CorpusRecord: index=%d}' % self._index
+
+
+class Corpus(object):
+    def __init__(self, path):
+        '''Open a corpus file written by write_corpus.
+
+        The file is memory mapped read-only; call close() (or use the corpus
+        as a context manager) to release it.
+        '''
+        self._path = path
+        self._file = open(path, 'rb')
+        self._map = None
+        try:
+            # mmap refuses empty files, and a truncated file has no header
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            header = _HEADER.unpack_from(self._map, 0)
+        except (ValueError, struct.error):
+            header = None
+        if (header is None or header[0] != MAGIC or header[1] != VERSION or
+                header[2] != len(_STORED)):
+            self.close()
+            raise ValueError('Not a corpus file: %s' % path)
+        magic, version, ncols, count, mtime, size, transliterate = header
+
+        self._count = count
+        self._transliterate = transliterate
+        if transliterate:
+            self._key_type = TransliteratedSearchKey
+        else:
+            self._key_type = SearchKey
+        self._flags_start = _HEADER.size
+        table_start = self._flags_start + count
+        table_size = (count + 1) * _OFFSET.size
+        self._tables = dict((name, table_start + i * table_size)
+                            for i, name in enumerate(_STORED))
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [CorpusRecord(self, i)
+                    for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('corpus index out of range')
+        return CorpusRecord(self, index)
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield CorpusRecord(self, i)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def transliterate(self):
+        '''True if the corpus's search keys are transliterated'''
+        return self._transliterate
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def items(self):
+        '''Return all the items in the corpus as Items'''
+        return [record.to_item() for record in self]
+
+    def search_keys(self):
+        '''Yield the search key of each item, in order'''
+        table = struct.unpack_from('<%dI' % (self._count + 1), self._map,
+                                   self._tables['key'])
+        key_type = self._key_type
+        data = self._map
+        for i in range(self._count):
+            yield key_type(data[table[i]:table[i + 1]].decode('utf-8'))
+
+    def _flags(self, index):
+        return _FLAGS.unpack_from(self._map, self._flags_start + index)[0]
+
+    def _value(self, name, index, flags=None):
+        if flags is None:
+            flags = self._flags(index)
+        if flags & _NULL_BITS.get(name, 0):
+            return None
+
+        table = self._tables[name] + index * _OFFSET.size
+        start, end = _SPAN.unpack_from(self._map, table)
+        value = self._map[start:end].decode('utf-8')
+
+        if name == 'icon' and flags & _ICON_DICT:
+            value = json.loads(value)
+        return value
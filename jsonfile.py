@@ -5,10 +5,15 @@ import os.path
 
 LOG = logging.getLogger(__name__)
 
+# default journal compaction thresholds
+JOURNAL_SIZE = 64 * 1024
+JOURNAL_RATIO = 1.0
+
 
 class JsonFile(object):
     def __init__(self, path, default_data=None, ignore_errors=False,
-                 header=None):
+                 header=None, journal=False, compact_size=JOURNAL_SIZE,
+                 compact_ratio=JOURNAL_RATIO):
         '''Construct a new JsonFile.
 
         Parameters
@@ -25,10 +30,27 @@ class JsonFile(object):
             A comment header to include with the file. This should be a string
             or a list of strings. Necessary comment tags will be added
             automatically.
+
+        journal : boolean
+            Set to True to record changes in a sidecar journal file
+            ([path].journal) rather than rewriting the whole file on every
+            change. The main file is rewritten when the journal is compacted.
+
+        compact_size : int
+            The journal is compacted when it grows larger than this many
+            bytes.
+
+        compact_ratio : float
+            The journal is also compacted when it grows larger than this
+            multiple of the size of the main file.
         '''
         self._data = {}
         self._path = path
         self._header = header
+        self._journal = journal
+        self._journal_path = path + '.journal'
+        self._compact_size = compact_size
+        self._compact_ratio = compact_ratio
 
         if os.path.exists(path):
             try:
@@ -47,6 +69,8 @@ class JsonFile(object):
             self._data = default_data
             self._save()
 
+        self._replay()
+
     def __contains__(self, key):
         return key in self._data
 
@@ -55,11 +79,17 @@ class JsonFile(object):
 
     def __delitem__(self, key):
         del self._data[key]
-        self._save()
+        if self._journal:
+            self._append({'del': key})
+        else:
+            self._save()
 
     def __setitem__(self, key, value):
         self._data[key] = value
-        self._save()
+        if self._journal:
+            self._append({'set': key, 'value': value})
+        else:
+            self._save()
 
     def __iter__(self):
         return self._data.__iter__()
@@ -86,6 +116,52 @@ class JsonFile(object):
     def get(self, key, default=None):
         return self._data.get(key, default)
 
+    def compact(self):
+        '''Fold any journaled changes into the main file.'''
+        self._save()
+
+    def _replay(self):
+        '''Apply journaled changes on top of the data in the main file.'''
+        if not os.path.exists(self._journal_path):
+            return
+
+        damaged = False
+        with open(self._journal_path, 'rt') as jfile:
+            for line in jfile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    LOG.warn('ignoring damaged journal record in %s',
+                             self._journal_path)
+                    damaged = True
+                    continue
+                if 'set' in record:
+                    self._data[record['set']] = record['value']
+                else:
+                    self._data.pop(record['del'], None)
+
+        if damaged:
+            # rewrite the file so the damaged records are dropped and new
+            # records aren't appended to a partial one
+            self._save()
+
+    def _append(self, record):
+        # JSON object keys are always strings, so store keys the way they'll
+        # be read back from the main file
+        for op in ('set', 'del'):
+            if op in record:
+                record[op] = list(json.loads(json.dumps({record[op]: 0})))[0]
+
+        with open(self._journal_path, 'at') as jfile:
+            jfile.write(json.dumps(record) + '\n')
+
+        size = os.path.getsize(self._journal_path)
+        base_size = os.path.getsize(self._path) if os.path.exists(
+            self._path) else 0
+        if size > self._compact_size or size > self._compact_ratio * base_size:
+            LOG.debug('compacting journal for %s', self._path)
+            self._save()
+
     def _save(self):
         with open(self._path, 'wt') as cfile:
             if self.header:
@@ -94,3 +170,7 @@ class JsonFile(object):
                 for line in self.header:
                     cfile.write('// {0}\n'.format(line))
             json.dump(self._data, cfile, indent=2)
+
+        # the main file now holds everything, so any journal is stale
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
@@ -0,0 +1,263 @@
+'''Replay recorded workflow sessions and report handler latency.
+
+Sessions are recorded by a Workflow when its record_sessions setting is on.
+Each tell or do call is then appended to [cache_dir]/sessions.log, and that
+file can be fed back through a Workflow subclass with replay() to measure how
+long each keystroke takes. From the command line:
+
+    python -m jcalfred.replay my_workflow:MyWorkflow sessions.log \
+        --data-dir [data_dir] --cache-dir [cache_dir]
+'''
+
+import json
+import logging
+import os
+import os.path
+import plistlib
+import shutil
+import tempfile
+from timeit import default_timer
+from . import alfred
+from .jsonfile import JsonFile
+
+
+REPLAY_BUNDLE_ID = 'jcalfred.replay'
+
+# settings that would skew the timings if they were copied from a real
+# workflow's config
+REPLAY_CONFIG = {
+    'record_sessions': False,
+    'memory_report': False
+}
+
+
+def load_session(path):
+    '''Load the calls recorded in a session log'''
+    calls = []
+    with open(path, 'rt') as sfile:
+        for line in sfile:
+            line = line.strip()
+            if line:
+                calls.append(json.loads(line))
+    return calls
+
+
+def _percentile(values, fraction):
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(latencies, errors=None):
+    '''Return latency statistics for each handler.
+
+    latencies and errors are the dicts returned by replay(). The statistics
+    are in seconds, and only cover calls that succeeded; 'errors' is the
+    number of calls that failed.
+    '''
+    errors = errors or {}
+    summary = {}
+    for name in set(latencies) | set(errors):
+        values = sorted(latencies.get(name, []))
+        stats = {'count': len(values), 'errors': errors.get(name, 0)}
+        if values:
+            stats.update({
+                'mean': sum(values) / len(values),
+                'min': values[0],
+                'p50': _percentile(values, 0.5),
+                'p90': _percentile(values, 0.9),
+                'p99': _percentile(values, 0.99),
+                'max': values[-1]
+            })
+        summary[name] = stats
+    return summary
+
+
+class _ErrorCounter(logging.Handler):
+    '''Counts the errors that Workflow.tell and do log (and then swallow)'''
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def _replay_info(data_dir, cache_dir):
+    '''Return a WorkflowInfo class that uses the given data and cache
+    directories instead of Alfred's'''
+
+    class ReplayInfo(alfred.WorkflowInfo):
+        def __init__(self, path=None):
+            super(ReplayInfo, self).__init__(path)
+            self._data_dir = data_dir
+            self._cache_dir = cache_dir
+            self.config_file = os.path.join(data_dir, 'config.json')
+
+    return ReplayInfo
+
+
+def _setup(root, workflow_dir, data_dir, cache_dir, config):
+    '''Populate a replay directory, returning the paths of the workflow, data
+    and cache directories in it'''
+    paths = [os.path.join(root, name) for name in
+             ('user.workflow.replay', 'data', 'cache')]
+    replay_dir, replay_data, replay_cache = paths
+
+    if workflow_dir:
+        shutil.copytree(workflow_dir, replay_dir)
+    else:
+        os.mkdir(replay_dir)
+        plist = {
+            'bundleid': REPLAY_BUNDLE_ID,
+            'name': 'Replay',
+            'readme': ''
+        }
+        plistlib.writePlist(plist, os.path.join(replay_dir, 'info.plist'))
+
+    for source, dest in ((data_dir, replay_data), (cache_dir, replay_cache)):
+        if source:
+            shutil.copytree(source, dest)
+        else:
+            os.mkdir(dest)
+
+    settings = JsonFile(os.path.join(replay_data, 'config.json'))
+    for key, value in dict(REPLAY_CONFIG, **(config or {})).items():
+        settings[key] = value
+
+    return paths
+
+
+def replay(workflow_class, session, include_do=False, workflow_dir=None,
+           data_dir=None, cache_dir=None, config=None):
+    '''Run a recorded session through a Workflow subclass.
+
+    session may be a path to a session log or a list of recorded calls. Each
+    call gets a new workflow instance, as it would from Alfred, and is timed
+    from the creation of the instance to the end of the call.
+
+    The workflow runs in a temporary directory that's removed afterwards.
+    workflow_dir, data_dir and cache_dir are copied into it if given, so a
+    replay can use a real workflow's files, settings and data without
+    changing them; otherwise it gets a fake info.plist and empty directories.
+    config is a dict of settings to apply on top of the copied config (e.g.
+    {'loglevel': 'INFO'}). do calls are skipped unless include_do is True,
+    since they usually have side effects.
+
+    Returns two dicts, both keyed by handler name ('tell_foo', 'do_bar'): the
+    first maps to the durations in seconds of the calls that succeeded, in
+    the order they were replayed, and the second to the number of calls that
+    failed (logged an error).
+    '''
+    if not isinstance(session, (list, tuple)):
+        session = load_session(session)
+
+    root = tempfile.mkdtemp()
+    latencies = {}
+    errors = {}
+    logger = logging.getLogger()
+    level = logger.level
+    original_info = alfred.WorkflowInfo
+    cwd = os.getcwd()
+
+    try:
+        replay_dir, replay_data, replay_cache = _setup(
+            root, workflow_dir, data_dir, cache_dir, config)
+        alfred.WorkflowInfo = _replay_info(replay_data, replay_cache)
+        os.chdir(replay_dir)
+
+        for call in session:
+            kind = call.get('kind', 'tell')
+            if kind == 'do' and not include_do:
+                continue
+
+            counter = _ErrorCounter()
+            handlers = list(logger.handlers)
+            logger.addHandler(counter)
+            try:
+                start = default_timer()
+                workflow = workflow_class()
+                # errors are how failed calls are spotted, so they have to
+                # get past the root logger even at quieter log levels; the
+                # workflow's own handlers keep its level
+                if logger.level > logging.ERROR:
+                    for handler in logger.handlers:
+                        if handler not in handlers and handler is not counter:
+                            handler.setLevel(logger.level)
+                    logger.setLevel(logging.ERROR)
+                # replayed output isn't interesting, only how long it took to
+                # produce
+                workflow.puts = lambda msg: None
+                if kind == 'do':
+                    workflow.do(call['name'], call['query'],
+                                call.get('modifier'))
+                else:
+                    workflow.tell(call['name'], call['query'])
+                duration = default_timer() - start
+            finally:
+                # each Workflow adds a log handler, which would pile up over
+                # the session when a real process would only have one
+                for handler in list(logger.handlers):
+                    if handler not in handlers:
+                        logger.removeHandler(handler)
+
+            handler = '%s_%s' % (kind, call['name'])
+            if counter.count:
+                errors[handler] = errors.get(handler, 0) + 1
+            else:
+                latencies.setdefault(handler, []).append(duration)
+    finally:
+        alfred.WorkflowInfo = original_info
+        logger.setLevel(level)
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    return latencies, errors
+
+
+def format_summary(summary):
+    '''Format a summary from summarize() as a table (times in ms)'''
+    columns = ('count', 'errors', 'mean', 'min', 'p50', 'p90', 'p99', 'max')
+    lines = ['%-24s' % 'handler' + ''.join('%10s' % c for c in columns)]
+    for name in sorted(summary):
+        stats = summary[name]
+        line = '%-24s%10d%10d' % (name, stats['count'], stats['errors'])
+        for c in columns[2:]:
+            if c in stats:
+                line += '%10.2f' % (stats[c] * 1000)
+            else:
+                line += '%10s' % '-'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    from argparse import ArgumentParser
+    from importlib import import_module
+
+    parser = ArgumentParser(description='Replay a recorded workflow session')
+    parser.add_argument('workflow', help='workflow class, as module:Class')
+    parser.add_argument('session', help='session log to replay')
+    parser.add_argument('--do', action='store_true', dest='include_do',
+                        help='also replay do calls')
+    parser.add_argument('--workflow-dir',
+                        help='workflow directory to copy (with info.plist)')
+    parser.add_argument('--data-dir', help='workflow data directory to copy')
+    parser.add_argument('--cache-dir', help='workflow cache directory to copy')
+    parser.add_argument('--loglevel', help='log level to replay with')
+    args = parser.parse_args()
+
+    config = {}
+    if args.loglevel:
+        config['loglevel'] = args.loglevel
+
+    module_name, sep, class_name = args.workflow.partition(':')
+    workflow_class = getattr(import_module(module_name), class_name)
+    latencies, errors = replay(workflow_class, args.session, args.include_do,
+                               args.workflow_dir, args.data_dir,
+                               args.cache_dir, config)
+    print(format_summary(summarize(latencies, errors)))
+
+
+if __name__ == '__main__':
+    main()
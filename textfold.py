@@ -0,0 +1,79 @@
+# coding=UTF-8
+
+'''Fold text into keys for case and accent insensitive matching.'''
+
+import re
+import unicodedata
+
+
+# characters that Unicode decomposition doesn't reduce to ASCII letters
+TRANSLITERATIONS = {
+    u'Æ': u'AE', u'æ': u'ae',
+    u'Ð': u'D', u'ð': u'd',
+    u'Ø': u'O', u'ø': u'o',
+    u'Þ': u'TH', u'þ': u'th',
+    u'ß': u'ss',
+    u'Đ': u'D', u'đ': u'd',
+    u'ı': u'i',
+    u'Ł': u'L', u'ł': u'l',
+    u'Œ': u'OE', u'œ': u'oe',
+}
+
+# the combining diacritical mark blocks, which is where NFKD puts the accents
+# it splits off letters
+_COMBINING = re.compile(u'[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff'
+                        u'\u20d0-\u20ff\ufe20-\ufe2f]')
+_TRANSLITERABLE = re.compile(u'[%s]' % u''.join(TRANSLITERATIONS))
+
+
+def _transliterate(match):
+    return TRANSLITERATIONS[match.group()]
+
+
+class SearchKey(type(u'')):
+    '''A string that has already been folded (without transliteration)'''
+
+
+class TransliteratedSearchKey(type(u'')):
+    '''A string that has already been folded with transliteration'''
+
+
+def _casefold(text):
+    if hasattr(text, 'casefold'):
+        return text.casefold()
+    return text.lower()
+
+
+def _fold(text, transliterate):
+    text = unicodedata.normalize('NFKD', _casefold(text))
+    text = _COMBINING.sub(u'', text)
+    if transliterate:
+        text = _TRANSLITERABLE.sub(_transliterate, text)
+    # compatibility decompositions can introduce capitals (e.g. "㎒")
+    return _casefold(text)
+
+
+def fold(text, transliterate=False):
+    '''Return a search key for text.
+
+    The key is the NFKD decomposition of text with diacritics removed and case
+    folded, so that "Café" and "cafe" have the same key. If transliterate is
+    True, letters without a decomposition, such as "ø" and "æ", are also
+    replaced with ASCII equivalents. Byte strings are decoded as UTF-8.
+
+    Keys are returned as SearchKey (or TransliteratedSearchKey) strings, and
+    folding a key again in the same mode returns it unchanged, so keys can be
+    computed once and passed to the matchers as-is.
+    '''
+    key_type = TransliteratedSearchKey if transliterate else SearchKey
+    if text.__class__ is key_type:
+        return text
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+
+    # ASCII text only needs lowercasing, and is by far the most common case
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return key_type(_fold(text, transliterate))
+    return key_type(text.lower())